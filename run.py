@@ -1,17 +1,46 @@
+import glob
 import json
 import os
 import logging
+import sqlite3
+import time
+from collections import namedtuple
 import concurrent.futures
 import boto3
+import urllib3
 import argparse
+from functools import partial, reduce
 from botocore.config import Config
-from pyspark.sql import SparkSession
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+from prometheus_client import CollectorRegistry, Gauge, delete_from_gateway, push_to_gateway
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Define Prometheus metrics once; every table is a label set on the shared registry
+REGISTRY = CollectorRegistry()
+PARTITION_COUNT_GAUGE = Gauge('iceberg_table_partitions', 'Total partitions',
+                              ['database', 'table'], registry=REGISTRY)
+FILE_COUNT_GAUGE = Gauge('iceberg_table_files', 'Total files',
+                         ['database', 'table'], registry=REGISTRY)
+TOTAL_BYTES_GAUGE = Gauge('iceberg_storage_total_bytes', 'Total bytes',
+                          ['database', 'table'], registry=REGISTRY)
+TOTAL_RECORDS_GAUGE = Gauge('iceberg_table_records', 'Total records',
+                            ['database', 'table'], registry=REGISTRY)
+AVG_PARTITION_SIZE_GAUGE = Gauge('iceberg_table_avg_partition_size',
+                                 'Average partition size in bytes',
+                                 ['database', 'table'], registry=REGISTRY)
+
+# Add table info metric for counting
+TABLE_INFO = Gauge('iceberg_table_info', 'Iceberg table info',
+                   ['database', 'table'], registry=REGISTRY)
+
+# Background pool for gateway pushes so they don't block the main thread
+PUSH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+# Keep-alive HTTP connections to the Pushgateway, reused across pushes
+HTTP_POOL = urllib3.PoolManager()
+
 def parse_args():
     """Parse command line arguments"""
     parser = argparse.ArgumentParser(description='Collect Iceberg table metrics and push to Prometheus')
@@ -23,14 +52,31 @@ def parse_args():
     # Optional arguments
     parser.add_argument('--region', default='us-east-1',
                         help='AWS region (default: us-east-1)')
-    parser.add_argument('--spark-version', default='3.4',
-                        help='Spark version (default: 3.4)')
+    parser.add_argument('--engine', default='pyiceberg', choices=['pyiceberg', 'spark'],
+                        help='Engine used to read table metadata (default: pyiceberg)')
+    parser.add_argument('--spark-version', default='3.5',
+                        help='Spark version (default: 3.5)')
     parser.add_argument('--iceberg-version', default='1.7.0',
                         help='Iceberg version (default: 1.7.0)')
+    parser.add_argument('--jars-dir',
+                        help='Directory of pre-downloaded Spark jars; skips Ivy package resolution')
     parser.add_argument('--prometheus-gateway', default='localhost:9091',
                         help='Prometheus Pushgateway address (default: localhost:9091)')
-    parser.add_argument('--max-workers', type=int, default=1,
-                        help='Maximum number of worker threads (default: 1)')
+    parser.add_argument('--max-workers', type=int, default=min(32, 4 * (os.cpu_count() or 1)),
+                        help='Maximum number of worker threads for I/O-bound catalog calls '
+                             '(default: min(32, 4 * CPU count))')
+    parser.add_argument('--spark-workers', type=int, default=4,
+                        help='Maximum number of concurrent per-table Spark queries (default: 4)')
+    parser.add_argument('--cache-path', default=os.path.expanduser('~/.s3tables_metrics_cache.db'),
+                        help='SQLite file caching metrics by snapshot id (default: ~/.s3tables_metrics_cache.db)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Disable the snapshot metrics cache')
+    parser.add_argument('--catalog-cache-path', default=os.path.expanduser('~/.s3tables_catalog.json'),
+                        help='JSON file caching the namespace/table listing (default: ~/.s3tables_catalog.json)')
+    parser.add_argument('--catalog-ttl', type=int, default=300,
+                        help='Seconds to reuse the cached namespace/table listing, 0 to disable (default: 300)')
+    parser.add_argument('--refresh-catalog', action='store_true',
+                        help='Ignore the cached namespace/table listing and list tables again')
     parser.add_argument('--log-level', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help='Logging level (default: INFO)')
@@ -39,135 +85,469 @@ def parse_args():
 
 def create_spark_session(args):
     """Create and configure Spark session"""
+    from pyspark.sql import SparkSession
 
-    spark = SparkSession.builder.appName("iceberg_lab") \
+    builder = SparkSession.builder.appName("iceberg_lab") \
         .config("spark.sql.catalog.s3tablesbucket", "org.apache.iceberg.spark.SparkCatalog") \
         .config("spark.sql.catalog.s3tablesbucket.client.region", args.region) \
         .config("spark.sql.catalog.defaultCatalog", "s3tablesbucket") \
         .config("spark.sql.catalog.s3tablesbucket.warehouse", args.warehouse) \
-        .config("spark.sql.catalog.s3tablesbucket.catalog-impl", "software.amazon.s3tables.iceberg.S3TablesCatalog") \
-        .config("spark.jars.packages",
-                f"org.apache.iceberg:iceberg-spark-runtime-3.5_2.12:{args.iceberg_version},software.amazon.s3tables:s3-tables-catalog-for-iceberg-runtime:0.1.3,software.amazon.awssdk:glue:2.20.143,software.amazon.awssdk:sts:2.20.143,software.amazon.awssdk:s3:2.20.143,software.amazon.awssdk:dynamodb:2.20.143,software.amazon.awssdk:kms:2.20.143") \
-        .getOrCreate()
+        .config("spark.sql.catalog.s3tablesbucket.catalog-impl", "software.amazon.s3tables.iceberg.S3TablesCatalog")
+
+    if args.jars_dir:
+        # Use pre-downloaded jars and skip Ivy dependency resolution entirely
+        jars = sorted(glob.glob(os.path.join(args.jars_dir, '*.jar')))
+        if not jars:
+            raise ValueError(f"No jars found in {args.jars_dir}")
+        builder = builder.config("spark.jars", ",".join(f"file://{os.path.abspath(jar)}" for jar in jars))
+    else:
+        builder = builder.config("spark.jars.packages",
+                                 f"org.apache.iceberg:iceberg-spark-runtime-{args.spark_version}_2.12:{args.iceberg_version},software.amazon.s3tables:s3-tables-catalog-for-iceberg-runtime:0.1.3,software.amazon.awssdk:glue:2.20.143,software.amazon.awssdk:sts:2.20.143,software.amazon.awssdk:s3:2.20.143,software.amazon.awssdk:dynamodb:2.20.143,software.amazon.awssdk:kms:2.20.143")
+
+    spark = builder.getOrCreate()
     return spark
 
 
+def create_pyiceberg_catalog(args):
+    """Create PyIceberg catalog backed by the S3 Tables Iceberg REST endpoint"""
+    from pyiceberg.catalog import load_catalog
+
+    return load_catalog('s3tablesbucket', **{
+        'type': 'rest',
+        'warehouse': args.warehouse,
+        'uri': f'https://s3tables.{args.region}.amazonaws.com/iceberg',
+        'rest.sigv4-enabled': 'true',
+        'rest.signing-name': 's3tables',
+        'rest.signing-region': args.region,
+    })
+
+
 def get_s3tables_client(args):
-    """Create S3Tables client"""
-    return boto3.client('s3tables', region_name=args.region)
+    """Create S3Tables client, shared by all discovery threads (boto3 clients are thread-safe)"""
+    # Size the connection pool so parallel discovery calls don't queue behind it,
+    # and keep connections alive so they are reused across paginated calls
+    config = Config(
+        max_pool_connections=max(32, args.max_workers * 4),
+        retries={'mode': 'adaptive', 'max_attempts': 3},
+        tcp_keepalive=True
+    )
+    return boto3.client('s3tables', region_name=args.region, config=config)
+
+
+def partition_metrics_aggs():
+    """Aggregate expressions over a partitions metadata table, shared by the Spark queries"""
+    from pyspark.sql import functions as F
+
+    return [
+        F.count(F.lit(1)).alias('partition_count'),
+        F.sum('file_count').alias('total_files'),
+        F.sum('total_data_file_size_in_bytes').alias('total_bytes'),
+        F.sum('record_count').alias('total_records')
+    ]
+
+
+MetricsRow = namedtuple('MetricsRow',
+                        ['partition_count', 'total_files', 'total_bytes', 'total_records'])
+
+
+def build_table_metrics(namespace, table, row):
+    """Shape an aggregated partitions row into the metrics dict, coercing values to numbers"""
+    partition_count = int(row.partition_count or 0)
+    total_bytes = int(row.total_bytes or 0)
+    return {
+        "database": namespace,
+        "table": table,
+        "metrics": {
+            "partition_count": partition_count,
+            "file_count": int(row.total_files or 0),
+            "total_bytes": total_bytes,
+            "total_records": int(row.total_records or 0),
+            "avg_partition_size": (
+                    total_bytes / partition_count) if partition_count > 0 else 0
+        }
+    }
 
 
 def get_table_metrics(spark, namespace, table):
-    """Get essential table metrics using Spark SQL"""
+    """Get essential table metrics using the Spark DataFrame API"""
+    try:
+        metrics = spark.table(f"s3tablesbucket.{namespace}.{table}.partitions") \
+            .agg(*partition_metrics_aggs()) \
+            .first()
+
+        return build_table_metrics(namespace, table, metrics)
+    except Exception as e:
+        logger.error("Error getting metrics for %s.%s: %s", namespace, table, e)
+        return None
+
+
+def get_all_table_metrics(spark, table_pairs, max_workers):
+    """Get metrics for all tables in a single Spark job, falling back to per-table queries"""
+    from pyspark.sql import DataFrame, functions as F
+
     try:
-        query = f"""
-        SELECT 
-            count(*) as partition_count,
-            sum(file_count) as total_files,
-            sum(total_data_file_size_in_bytes) as total_bytes,
-            sum(record_count) as total_records
-        FROM s3tablesbucket.{namespace}.{table}.partitions
+        # Union every table's partitions metadata and aggregate once, so the driver
+        # submits one job and collects all results together
+        partitions = reduce(DataFrame.unionByName, [
+            spark.table(f"s3tablesbucket.{namespace}.{table}.partitions").select(
+                F.lit(namespace).alias('table_namespace'),
+                F.lit(table).alias('table_name'),
+                'file_count', 'total_data_file_size_in_bytes', 'record_count'
+            )
+            for namespace, table in table_pairs
+        ])
+
+        rows = partitions.groupBy('table_namespace', 'table_name').agg(*partition_metrics_aggs()).collect()
+
+        metrics_by_table = {
+            (row.table_namespace, row.table_name): build_table_metrics(row.table_namespace, row.table_name, row)
+            for row in rows
+        }
+        # Tables without partition rows produce no group
+        return [
+            metrics_by_table.get((namespace, table)) or
+            build_table_metrics(namespace, table, MetricsRow(0, 0, 0, 0))
+            for namespace, table in table_pairs
+        ]
+    except Exception as e:
+        logger.warning("Batched metrics query failed, falling back to per-table queries: %s", e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(get_table_metrics, spark, namespace, table)
+            for namespace, table in table_pairs
+        ]
+        results = [future.result() for future in futures]
+    return [metrics for metrics in results if metrics]
+
+
+# Snapshot id recorded for tables with no snapshot yet, so empty tables compare equal
+# across runs; None is reserved for tables whose snapshot couldn't be read
+NO_SNAPSHOT_ID = -1
+
+
+class MetricsCache:
+    """On-disk cache of aggregated table metrics keyed by Iceberg snapshot id"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS metrics_cache (
+                ns TEXT NOT NULL,
+                tbl TEXT NOT NULL,
+                snap_id INTEGER NOT NULL,
+                partition_count INTEGER,
+                file_count INTEGER,
+                total_bytes INTEGER,
+                total_records INTEGER,
+                PRIMARY KEY (ns, tbl)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS push_state (
+                ns TEXT NOT NULL,
+                tbl TEXT NOT NULL,
+                snap_id INTEGER NOT NULL,
+                PRIMARY KEY (ns, tbl)
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, namespace, table, snapshot_id):
+        """Return cached metrics for the snapshot, or None on a miss"""
+        row = self.conn.execute(
+            "SELECT partition_count, file_count, total_bytes, total_records FROM metrics_cache "
+            "WHERE ns = ? AND tbl = ? AND snap_id = ?",
+            (namespace, table, snapshot_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return build_table_metrics(namespace, table, MetricsRow(*row))
+
+    def get_latest(self, namespace, table):
+        """Return the last cached metrics for the table regardless of snapshot, or None"""
+        row = self.conn.execute(
+            "SELECT partition_count, file_count, total_bytes, total_records FROM metrics_cache "
+            "WHERE ns = ? AND tbl = ?",
+            (namespace, table)
+        ).fetchone()
+        if row is None:
+            return None
+        return build_table_metrics(namespace, table, MetricsRow(*row))
+
+    def put(self, snapshot_id, metrics):
+        """Store metrics for the table's current snapshot"""
+        values = metrics['metrics']
+        self.conn.execute(
+            "INSERT OR REPLACE INTO metrics_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (metrics['database'], metrics['table'], snapshot_id, values['partition_count'],
+             values['file_count'], values['total_bytes'], values['total_records'])
+        )
+
+    def is_pushed(self, snapshot_ids):
+        """Check whether exactly these table snapshots were pushed by the last run
+
+        Any added or removed table, or a table whose snapshot couldn't be read, counts as changed.
         """
+        if not snapshot_ids or None in snapshot_ids.values():
+            return False
+        pushed = {
+            (ns, tbl): snap_id
+            for ns, tbl, snap_id in self.conn.execute("SELECT ns, tbl, snap_id FROM push_state")
+        }
+        return pushed == snapshot_ids
+
+    def mark_pushed(self, snapshot_ids):
+        """Record the table snapshots whose metrics were pushed"""
+        self.conn.execute("DELETE FROM push_state")
+        self.conn.executemany(
+            "INSERT INTO push_state VALUES (?, ?, ?)",
+            [(ns, tbl, snap_id) for (ns, tbl), snap_id in snapshot_ids.items() if snap_id is not None]
+        )
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
 
-        metrics = spark.sql(query).collect()[0]
-
-        return {
-            "database": namespace,
-            "table": table,
-            "metrics": {
-                "partition_count": metrics.partition_count,
-                "file_count": metrics.total_files or 0,
-                "total_bytes": metrics.total_bytes or 0,
-                "total_records": metrics.total_records or 0,
-                "avg_partition_size": (
-                        metrics.total_bytes / metrics.partition_count) if metrics.partition_count > 0 else 0
-            }
+    def close(self):
+        self.conn.close()
+
+
+def get_current_snapshot_ids(spark, table_pairs):
+    """Get the current snapshot id of each table from the main branch in the refs metadata table"""
+    try:
+        query = "\nUNION ALL\n".join(
+            f"""
+        SELECT '{namespace}' as table_namespace, '{table}' as table_name, snapshot_id
+        FROM s3tablesbucket.{namespace}.{table}.refs
+        WHERE name = 'main'"""
+            for namespace, table in table_pairs
+        )
+
+        rows = spark.sql(query).collect()
+
+        # Tables without a snapshot have no main ref
+        snapshot_ids = {(row.table_namespace, row.table_name): row.snapshot_id for row in rows}
+        return {pair: snapshot_ids.get(pair, NO_SNAPSHOT_ID) for pair in table_pairs}
+    except Exception as e:
+        logger.warning("Error getting snapshot ids, skipping metrics cache: %s", e)
+        return {}
+
+
+def get_table_metrics_pyiceberg(catalog, namespace, table, iceberg_table=None):
+    """Get essential table metrics by reading Iceberg metadata with PyIceberg"""
+    import pyarrow.compute as pc
+
+    try:
+        if iceberg_table is None:
+            iceberg_table = catalog.load_table(f"{namespace}.{table}")
+        if iceberg_table.current_snapshot() is None:
+            return build_table_metrics(namespace, table, MetricsRow(0, 0, 0, 0))
+
+        # Keep the partitions data in Arrow and reduce each column with vectorized kernels
+        partitions = iceberg_table.inspect.partitions().select(
+            ['file_count', 'total_data_file_size_in_bytes', 'record_count'])
+        totals = {
+            name: pc.sum(partitions[name], min_count=0).as_py()
+            for name in partitions.column_names
         }
+
+        return build_table_metrics(namespace, table, MetricsRow(
+            partition_count=partitions.num_rows,
+            total_files=totals['file_count'],
+            total_bytes=totals['total_data_file_size_in_bytes'],
+            total_records=totals['record_count']
+        ))
     except Exception as e:
-        logger.error(f"Error getting metrics for {namespace}.{table}: {e}")
+        logger.error("Error getting metrics for %s.%s: %s", namespace, table, e)
         return None
 
 
-def push_metrics_to_prometheus(metrics, prometheus_gateway):
-    """Push metrics to Prometheus gateway"""
+def get_all_table_metrics_pyiceberg(catalog, table_pairs, max_workers, loaded_tables):
+    """Get metrics for all tables with PyIceberg, reusing tables loaded for snapshot ids"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(get_table_metrics_pyiceberg, catalog, namespace, table,
+                            loaded_tables.get((namespace, table)))
+            for namespace, table in table_pairs
+        ]
+        results = [future.result() for future in futures]
+    return [metrics for metrics in results if metrics]
+
+
+def load_table_pyiceberg(catalog, namespace, table):
+    """Load a table with PyIceberg, or None if it can't be loaded"""
     try:
-        registry = CollectorRegistry()
-
-        # Define Prometheus metrics
-        table_metrics = {
-            'partition_count': Gauge('iceberg_table_partitions', 'Total partitions',
-                                     ['database', 'table'], registry=registry),
-            'file_count': Gauge('iceberg_table_files', 'Total files',
-                                ['database', 'table'], registry=registry),
-            'total_bytes': Gauge('iceberg_storage_total_bytes', 'Total bytes',
-                                 ['database', 'table'], registry=registry),
-            'total_records': Gauge('iceberg_table_records', 'Total records',
-                                   ['database', 'table'], registry=registry),
-            'avg_partition_size': Gauge('iceberg_table_avg_partition_size',
-                                        'Average partition size in bytes',
-                                        ['database', 'table'], registry=registry)
+        return catalog.load_table(f"{namespace}.{table}")
+    except Exception as e:
+        logger.warning("Error loading %s.%s: %s", namespace, table, e)
+        return None
+
+
+def get_current_snapshot_ids_pyiceberg(catalog, table_pairs, max_workers, loaded_tables):
+    """Get the current snapshot id of each table from its metadata.json
+
+    Loaded tables are stored in loaded_tables so the aggregation can reuse them.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            (namespace, table): executor.submit(load_table_pyiceberg, catalog, namespace, table)
+            for namespace, table in table_pairs
         }
+        snapshot_ids = {}
+        for pair, future in futures.items():
+            iceberg_table = future.result()
+            if iceberg_table is None:
+                snapshot_ids[pair] = None
+                continue
+            loaded_tables[pair] = iceberg_table
+            current_snapshot_id = iceberg_table.metadata.current_snapshot_id
+            snapshot_ids[pair] = NO_SNAPSHOT_ID if current_snapshot_id is None else current_snapshot_id
+        return snapshot_ids
+
+
+def get_cached_table_metrics(table_pairs, cache, snapshot_ids, get_metrics):
+    """Get metrics for all tables, only aggregating tables whose snapshot changed
+
+    Returns the metrics and the snapshot id of each table whose metrics are current.
+    Tables that fail to aggregate carry forward their last cached values, so the
+    whole-job push doesn't drop them from the gateway, but are left out of the
+    snapshot ids so the next run retries them.
+    """
+    all_metrics = []
+    current_snapshot_ids = {}
+    stale_pairs = []
+    for namespace, table in table_pairs:
+        snapshot_id = snapshot_ids.get((namespace, table))
+        cached = cache.get(namespace, table, snapshot_id) if snapshot_id is not None else None
+        if cached:
+            all_metrics.append(cached)
+            current_snapshot_ids[(namespace, table)] = snapshot_id
+        else:
+            stale_pairs.append((namespace, table))
+    logger.info("Metrics cache: %s hits, %s misses", len(all_metrics), len(stale_pairs))
+
+    if stale_pairs:
+        fresh_metrics = get_metrics(stale_pairs)
+        for metrics in fresh_metrics:
+            pair = (metrics['database'], metrics['table'])
+            snapshot_id = snapshot_ids.get(pair)
+            if snapshot_id is not None:
+                cache.put(snapshot_id, metrics)
+            current_snapshot_ids[pair] = snapshot_id
+        cache.commit()
+        all_metrics.extend(fresh_metrics)
+
+        for namespace, table in stale_pairs:
+            if (namespace, table) in current_snapshot_ids:
+                continue
+            previous = cache.get_latest(namespace, table)
+            if previous:
+                logger.warning("Using last cached metrics for %s.%s", namespace, table)
+                all_metrics.append(previous)
 
-        # Add table info metric for counting
-        table_info = Gauge('iceberg_table_info', 'Iceberg table info',
-                           ['database', 'table'], registry=registry)
-
-        # Set labels
-        labels = {'database': metrics['database'], 'table': metrics['table']}
-
-        # Set table info metric for counting
-        table_info.labels(**labels).set(1)
-
-        # Set other metrics
-        logger.info(f"Setting metrics for {labels}")
-        for metric_name, value in metrics['metrics'].items():
-            if metric_name in table_metrics:
-                try:
-                    float_value = float(value)
-                    table_metrics[metric_name].labels(**labels).set(float_value)
-                    logger.info(f"Set {metric_name} = {float_value}")
-                except (TypeError, ValueError) as e:
-                    logger.error(f"Error converting {metric_name} value {value}: {e}")
-                    continue
-
-        # Push to Prometheus with grouping key
-        try:
-            push_to_gateway(
+    return all_metrics, current_snapshot_ids
+
+
+def set_table_metrics(metrics):
+    """Set the gauges for a single table on the shared registry"""
+    # Set labels
+    labels = {'database': metrics['database'], 'table': metrics['table']}
+
+    # Set table info metric for counting
+    TABLE_INFO.labels(**labels).set(1)
+
+    # Set other metrics; values are already numeric from build_table_metrics
+    values = metrics['metrics']
+    PARTITION_COUNT_GAUGE.labels(**labels).set(values['partition_count'])
+    FILE_COUNT_GAUGE.labels(**labels).set(values['file_count'])
+    TOTAL_BYTES_GAUGE.labels(**labels).set(values['total_bytes'])
+    TOTAL_RECORDS_GAUGE.labels(**labels).set(values['total_records'])
+    AVG_PARTITION_SIZE_GAUGE.labels(**labels).set(values['avg_partition_size'])
+    logger.info("Set metrics for %s: %s", labels, values)
+
+
+class PushgatewayError(IOError):
+    """Error response from the Pushgateway"""
+
+    def __init__(self, status, reason):
+        super().__init__(f"error talking to pushgateway: {status} {reason}")
+        self.status = status
+
+
+def keepalive_handler(url, method, timeout, headers, data):
+    """Pushgateway handler that sends requests over the shared keep-alive connection pool"""
+    def handle():
+        response = HTTP_POOL.request(method, url, body=data, headers=dict(headers), timeout=timeout)
+        if response.status >= 400:
+            raise PushgatewayError(response.status, response.reason)
+
+    return handle
+
+
+def delete_legacy_table_groups(prometheus_gateway):
+    """Delete per-table groups left by earlier versions that pushed each table under its own grouping key"""
+    url = prometheus_gateway if '://' in prometheus_gateway else f'http://{prometheus_gateway}'
+    response = HTTP_POOL.request('GET', f"{url.rstrip('/')}/api/v1/metrics", timeout=30)
+    if response.status >= 400:
+        raise PushgatewayError(response.status, response.reason)
+
+    for group in json.loads(response.data).get('data', []):
+        labels = group.get('labels', {})
+        if labels.get('job') == 'iceberg_metrics' and 'database' in labels and 'table' in labels:
+            delete_from_gateway(
                 prometheus_gateway,
                 job='iceberg_metrics',
-                registry=registry,
-                grouping_key={'database': metrics['database'], 'table': metrics['table']}
+                grouping_key={'database': labels['database'], 'table': labels['table']},
+                handler=keepalive_handler
             )
-            logger.info(f"✅ Successfully pushed metrics for {metrics['database']}.{metrics['table']}")
-        except Exception as push_error:
-            logger.error(f"Failed to push to Prometheus gateway: {push_error}")
-            raise
+            logger.info("Deleted legacy Pushgateway group for %s.%s", labels['database'], labels['table'])
 
+
+def push_metrics_to_prometheus(prometheus_gateway):
+    """Push all table metrics to Prometheus gateway in a single request"""
+    try:
+        try:
+            push_to_gateway(prometheus_gateway, job='iceberg_metrics', registry=REGISTRY,
+                            handler=keepalive_handler)
+        except PushgatewayError as e:
+            # The gateway rejects series that another group already holds, which happens
+            # once after upgrading while per-table groups from earlier versions remain
+            if e.status != 400:
+                raise
+            logger.warning("Push rejected, deleting legacy per-table groups and retrying: %s", e)
+            delete_legacy_table_groups(prometheus_gateway)
+            push_to_gateway(prometheus_gateway, job='iceberg_metrics', registry=REGISTRY,
+                            handler=keepalive_handler)
+        logger.info("✅ Successfully pushed metrics to Prometheus gateway")
     except Exception as e:
-        logger.error(f"Error in push_metrics_to_prometheus: {str(e)}")
+        logger.error("Failed to push to Prometheus gateway: %s", e)
         raise
 
 
-def process_table(spark, namespace, table, prometheus_gateway):
-    """Process a single table"""
+def process_table(metrics):
+    """Report and record metrics for a single table"""
     try:
-        metrics = get_table_metrics(spark, namespace, table)
-        if metrics:
-            print(json.dumps(metrics, indent=2))
-            push_metrics_to_prometheus(metrics, prometheus_gateway)
-            return True
-        return False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", json.dumps(metrics, separators=(',', ':')))
+        set_table_metrics(metrics)
+        return True
     except Exception as e:
-        logger.error(f"Error processing {namespace}.{table}: {e}")
+        logger.error("Error processing %s.%s: %s", metrics['database'], metrics['table'], e)
         return False
 
 
+# Largest page size accepted by the S3 Tables list APIs
+LIST_PAGE_SIZE = 1000
+
+
 def list_namespaces(s3tables_client, warehouse_arn):
     """List namespaces"""
     try:
         namespaces = []
         paginator = s3tables_client.get_paginator('list_namespaces')
-        for page in paginator.paginate(tableBucketARN=warehouse_arn):
+        for page in paginator.paginate(tableBucketARN=warehouse_arn,
+                                       PaginationConfig={'PageSize': LIST_PAGE_SIZE}):
             for namespace in page['namespaces']:
                 # Extract string value from namespace list
                 namespace_value = namespace['namespace']
@@ -176,7 +556,7 @@ def list_namespaces(s3tables_client, warehouse_arn):
                 namespaces.append(namespace_value)
         return namespaces
     except Exception as e:
-        logger.error(f"Error listing namespaces: {e}")
+        logger.error("Error listing namespaces: %s", e)
         return []
 
 
@@ -188,15 +568,88 @@ def list_tables(s3tables_client, warehouse_arn, namespace):
 
         tables = []
         paginator = s3tables_client.get_paginator('list_tables')
-        for page in paginator.paginate(tableBucketARN=warehouse_arn, namespace=namespace):
+        for page in paginator.paginate(tableBucketARN=warehouse_arn, namespace=namespace,
+                                       PaginationConfig={'PageSize': LIST_PAGE_SIZE}):
             for table in page['tables']:
                 tables.append(table['name'])
         return tables
     except Exception as e:
-        logger.error(f"Error listing tables for {namespace}: {e}")
+        logger.error("Error listing tables for %s: %s", namespace, e)
         return []
 
 
+def get_table_format(s3tables_client, warehouse_arn, namespace, table):
+    """Get the table format (e.g. ICEBERG), or None if it can't be determined"""
+    try:
+        response = s3tables_client.get_table(tableBucketARN=warehouse_arn, namespace=namespace, name=table)
+        return response.get('format')
+    except Exception as e:
+        logger.warning("Error getting format for %s.%s: %s", namespace, table, e)
+        return None
+
+
+def discover_all_tables(s3tables_client, warehouse_arn, max_workers):
+    """List tables in every namespace concurrently, returning (namespace, table) pairs"""
+    namespaces = list_namespaces(s3tables_client, warehouse_arn)
+    logger.info("Found namespaces: %s", namespaces)
+
+    table_pairs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(list_tables, s3tables_client, warehouse_arn, namespace): namespace
+            for namespace in namespaces
+        }
+        for future in concurrent.futures.as_completed(futures):
+            namespace = futures[future]
+            try:
+                tables = future.result()
+            except Exception as exc:
+                logger.error("Error discovering tables for %s: %s", namespace, exc)
+                continue
+            logger.info("Found tables in %s: %s", namespace, tables)
+            table_pairs.extend((namespace, table) for table in tables)
+
+        # Skip non-Iceberg tables up front rather than failing later in the metrics engine;
+        # tables whose format can't be read are kept
+        formats = executor.map(
+            lambda pair: get_table_format(s3tables_client, warehouse_arn, *pair), table_pairs)
+        iceberg_pairs = []
+        for pair, table_format in zip(table_pairs, list(formats)):
+            if table_format is None or table_format.upper() == 'ICEBERG':
+                iceberg_pairs.append(pair)
+            else:
+                logger.info("Skipping %s.%s with unsupported format %s", *pair, table_format)
+    return iceberg_pairs
+
+
+def load_cached_table_pairs(path, warehouse_arn, ttl):
+    """Return the cached (namespace, table) listing if it is fresh, otherwise None"""
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Treat any malformed payload as a miss
+    if not isinstance(cached, dict):
+        return None
+    try:
+        if cached['warehouse'] != warehouse_arn or time.time() - cached['timestamp'] >= ttl:
+            return None
+        return [(namespace, table) for namespace, table in cached['table_pairs']]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def save_cached_table_pairs(path, warehouse_arn, table_pairs):
+    """Store the (namespace, table) listing with the current time"""
+    try:
+        with open(path, 'w') as f:
+            json.dump({'timestamp': time.time(), 'warehouse': warehouse_arn, 'table_pairs': table_pairs}, f)
+    except OSError as e:
+        logger.warning("Error writing catalog cache %s: %s", path, e)
+
+
 def main():
     # Parse command line arguments
     args = parse_args()
@@ -205,45 +658,77 @@ def main():
     logging.getLogger().setLevel(getattr(logging, args.log_level))
 
     spark = None
+    cache = None
+    pushed_snapshot_ids = {}
+    push_futures = []
     try:
         # Initialize services
-        spark = create_spark_session(args)
-        spark.sparkContext.setLogLevel("ERROR")
+        if args.engine == 'spark':
+            spark = create_spark_session(args)
+            spark.sparkContext.setLogLevel("ERROR")
+            get_snapshot_ids = partial(get_current_snapshot_ids, spark)
+            get_metrics = partial(get_all_table_metrics, spark, max_workers=args.spark_workers)
+        else:
+            catalog = create_pyiceberg_catalog(args)
+            loaded_tables = {}
+            get_snapshot_ids = partial(get_current_snapshot_ids_pyiceberg, catalog,
+                                       max_workers=args.max_workers, loaded_tables=loaded_tables)
+            get_metrics = partial(get_all_table_metrics_pyiceberg, catalog,
+                                  max_workers=args.max_workers, loaded_tables=loaded_tables)
         s3tables_client = get_s3tables_client(args)
         logger.info("✅ Initialized services")
-        logger.info(f"Using warehouse: {args.warehouse}")
-
-        # Process namespaces
-        namespaces = list_namespaces(s3tables_client, args.warehouse)
-        logger.info(f"Found namespaces: {namespaces}")
-
-        for namespace in namespaces:
-            logger.info(f"Processing namespace: {namespace}")
-
-            tables = list_tables(s3tables_client, args.warehouse, namespace)
-            logger.info(f"Found tables in {namespace}: {tables}")
-
-            if not tables:
-                continue
-
-            # Process tables using thread pool
-            with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:
-                futures = [
-                    executor.submit(process_table, spark, namespace, table, args.prometheus_gateway)
-                    for table in tables
-                ]
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        future.result()
-                    except Exception as exc:
-                        logger.error(f"Thread execution error: {exc}")
+        logger.info("Using warehouse: %s", args.warehouse)
+
+        # Discover tables across all namespaces, reusing a recent listing when available
+        table_pairs = None
+        if args.catalog_ttl > 0 and not args.refresh_catalog:
+            table_pairs = load_cached_table_pairs(args.catalog_cache_path, args.warehouse, args.catalog_ttl)
+            if table_pairs is not None:
+                logger.info("Using cached table listing: %s tables", len(table_pairs))
+        if table_pairs is None:
+            table_pairs = discover_all_tables(s3tables_client, args.warehouse, args.max_workers)
+            if table_pairs and args.catalog_ttl > 0:
+                save_cached_table_pairs(args.catalog_cache_path, args.warehouse, table_pairs)
+        if not table_pairs:
+            logger.info("No tables found")
+            return
+
+        # Collect metrics for all tables, reusing cached values for unchanged snapshots
+        if args.no_cache:
+            all_metrics = get_metrics(table_pairs)
+        else:
+            cache = MetricsCache(args.cache_path)
+            snapshot_ids = get_snapshot_ids(table_pairs)
+            if cache.is_pushed(snapshot_ids):
+                # The gateway already holds these values; leave them in place
+                logger.info("No tables changed since the last push, skipping")
+                return
+            all_metrics, pushed_snapshot_ids = get_cached_table_metrics(
+                table_pairs, cache, snapshot_ids, get_metrics)
+
+        # Record metrics on the shared registry
+        for metrics in all_metrics:
+            process_table(metrics)
+
+        # Push every table's metrics in one background request, overlapping engine shutdown
+        push_futures.append(PUSH_POOL.submit(push_metrics_to_prometheus, args.prometheus_gateway))
 
     except Exception as e:
-        logger.error(f"Main execution error: {e}")
+        logger.error("Main execution error: %s", e)
     finally:
         if spark:
             spark.stop()
             logger.info("✅ Stopped Spark session")
+        for future in push_futures:
+            try:
+                future.result()
+                if cache:
+                    cache.mark_pushed(pushed_snapshot_ids)
+            except Exception as exc:
+                logger.error("Push execution error: %s", exc)
+        if cache:
+            cache.close()
+        PUSH_POOL.shutdown()
 
 
 if __name__ == "__main__":
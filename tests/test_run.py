@@ -0,0 +1,168 @@
+from collections import namedtuple
+from types import SimpleNamespace
+
+import pytest
+
+import run
+
+SnapshotRow = namedtuple('SnapshotRow', ['table_namespace', 'table_name', 'snapshot_id'])
+
+
+class FakeCatalog:
+    """Catalog returning tables with fixed current snapshot ids"""
+
+    def __init__(self, snapshot_ids):
+        self.snapshot_ids = snapshot_ids
+
+    def load_table(self, identifier):
+        namespace, table = identifier.split('.')
+        return SimpleNamespace(metadata=SimpleNamespace(
+            current_snapshot_id=self.snapshot_ids[(namespace, table)]))
+
+
+class FakeSpark:
+    """Spark session whose queries return fixed rows"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def sql(self, query):
+        return SimpleNamespace(collect=lambda: self.rows)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = run.MetricsCache(str(tmp_path / 'metrics.db'))
+    yield cache
+    cache.close()
+
+
+def test_is_pushed_after_identical_runs_with_empty_table_pyiceberg(cache):
+    table_pairs = [('db', 'orders'), ('db', 'empty')]
+    catalog = FakeCatalog({('db', 'orders'): 42, ('db', 'empty'): None})
+
+    snapshot_ids = run.get_current_snapshot_ids_pyiceberg(catalog, table_pairs, 2, {})
+    assert snapshot_ids[('db', 'empty')] == run.NO_SNAPSHOT_ID
+    assert not cache.is_pushed(snapshot_ids)
+    cache.mark_pushed(snapshot_ids)
+
+    snapshot_ids = run.get_current_snapshot_ids_pyiceberg(catalog, table_pairs, 2, {})
+    assert cache.is_pushed(snapshot_ids)
+
+
+def test_is_pushed_after_identical_runs_with_empty_table_spark(cache):
+    table_pairs = [('db', 'orders'), ('db', 'empty')]
+    # The empty table has no main ref, so it returns no row
+    spark = FakeSpark([SnapshotRow('db', 'orders', 42)])
+
+    snapshot_ids = run.get_current_snapshot_ids(spark, table_pairs)
+    assert snapshot_ids == {('db', 'orders'): 42, ('db', 'empty'): run.NO_SNAPSHOT_ID}
+    cache.mark_pushed(snapshot_ids)
+
+    assert cache.is_pushed(run.get_current_snapshot_ids(spark, table_pairs))
+
+
+def test_is_pushed_detects_new_empty_table(cache):
+    cache.mark_pushed({('db', 'orders'): 42})
+
+    assert not cache.is_pushed({('db', 'orders'): 42, ('db', 'empty'): run.NO_SNAPSHOT_ID})
+
+
+def test_is_pushed_detects_removed_table(cache):
+    cache.mark_pushed({('db', 'orders'): 42, ('db', 'old'): 7})
+
+    assert not cache.is_pushed({('db', 'orders'): 42})
+
+
+def test_is_pushed_false_when_snapshot_unreadable(cache):
+    cache.mark_pushed({('db', 'orders'): 42})
+
+    assert not cache.is_pushed({('db', 'orders'): 42, ('db', 'broken'): None})
+
+
+def make_metrics(namespace, table, total_bytes):
+    return run.build_table_metrics(namespace, table, run.MetricsRow(2, 3, total_bytes, 10))
+
+
+def test_cache_hit_and_miss(cache):
+    cache.put(42, make_metrics('db', 'orders', 100))
+    cache.commit()
+
+    assert cache.get('db', 'orders', 42) == make_metrics('db', 'orders', 100)
+    assert cache.get('db', 'orders', 43) is None
+    assert cache.get('db', 'other', 42) is None
+
+
+def test_cached_table_metrics_only_aggregates_changed_tables(cache):
+    cache.put(1, make_metrics('db', 'orders', 100))
+    cache.put(1, make_metrics('db', 'events', 200))
+    aggregated = []
+
+    def get_metrics(table_pairs):
+        aggregated.extend(table_pairs)
+        return [make_metrics(namespace, table, 300) for namespace, table in table_pairs]
+
+    all_metrics, current_snapshot_ids = run.get_cached_table_metrics(
+        [('db', 'orders'), ('db', 'events')], cache,
+        {('db', 'orders'): 1, ('db', 'events'): 2}, get_metrics)
+
+    assert aggregated == [('db', 'events')]
+    assert all_metrics == [make_metrics('db', 'orders', 100), make_metrics('db', 'events', 300)]
+    assert current_snapshot_ids == {('db', 'orders'): 1, ('db', 'events'): 2}
+    assert cache.get('db', 'events', 2) == make_metrics('db', 'events', 300)
+
+
+def test_cached_table_metrics_carries_forward_failed_table(cache):
+    cache.put(1, make_metrics('db', 'orders', 100))
+
+    all_metrics, current_snapshot_ids = run.get_cached_table_metrics(
+        [('db', 'orders'), ('db', 'new')], cache,
+        {('db', 'orders'): 2, ('db', 'new'): 5}, lambda table_pairs: [])
+
+    # The last cached values are pushed again, but the table is retried next run
+    assert all_metrics == [make_metrics('db', 'orders', 100)]
+    assert current_snapshot_ids == {}
+    assert not cache.is_pushed({('db', 'orders'): 2})
+
+
+def test_cached_table_metrics_skip_push_on_unchanged_run(cache):
+    table_pairs = [('db', 'orders'), ('db', 'empty')]
+    snapshot_ids = {('db', 'orders'): 42, ('db', 'empty'): run.NO_SNAPSHOT_ID}
+
+    def get_metrics(pairs):
+        return [make_metrics(namespace, table, 0) for namespace, table in pairs]
+
+    _, pushed_snapshot_ids = run.get_cached_table_metrics(table_pairs, cache, snapshot_ids, get_metrics)
+    cache.mark_pushed(pushed_snapshot_ids)
+
+    assert cache.is_pushed(snapshot_ids)
+    assert not cache.is_pushed({('db', 'orders'): 43, ('db', 'empty'): run.NO_SNAPSHOT_ID})
+
+
+def test_cached_table_pairs_round_trip(tmp_path):
+    path = str(tmp_path / 'catalog.json')
+    run.save_cached_table_pairs(path, 'arn:bucket', [('db', 'orders')])
+
+    assert run.load_cached_table_pairs(path, 'arn:bucket', 300) == [('db', 'orders')]
+    assert run.load_cached_table_pairs(path, 'arn:other', 300) is None
+    assert run.load_cached_table_pairs(path, 'arn:bucket', 0) is None
+
+
+@pytest.mark.parametrize('payload', [
+    'not json',
+    '[]',
+    'null',
+    '{}',
+    '{"warehouse": "arn:bucket", "timestamp": "soon", "table_pairs": []}',
+    '{"warehouse": "arn:bucket", "timestamp": 1e12, "table_pairs": [1]}',
+    '{"warehouse": "arn:bucket", "timestamp": 1e12, "table_pairs": [["db"]]}',
+])
+def test_load_cached_table_pairs_malformed_file_is_miss(tmp_path, payload):
+    path = tmp_path / 'catalog.json'
+    path.write_text(payload)
+
+    assert run.load_cached_table_pairs(str(path), 'arn:bucket', 300) is None
+
+
+def test_load_cached_table_pairs_missing_file_is_miss(tmp_path):
+    assert run.load_cached_table_pairs(str(tmp_path / 'missing.json'), 'arn:bucket', 300) is None